@@ -1,19 +1,25 @@
 import os
 import time
+import asyncio
 import json
 import csv
+import hashlib
+import pickle
+import sqlite3
 import logging
 import signal
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 from random import choice
+import orjson
 from dotenv import load_dotenv
-from openai import OpenAI
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
+from googleapiclient.discovery import build, build_from_document
+from googleapiclient.discovery_cache import get_static_doc
+from googleapiclient.errors import HttpError
 from email.utils import parseaddr
-from email.mime.text import MIMEText
 import base64
 
 # ======================================================
@@ -25,12 +31,33 @@ CREDENTIALS_PATH = os.path.join(BASE_DIR, 'credentials.json')
 TOKEN_PATH = os.path.join(BASE_DIR, 'token.json')
 REPLY_JSON_PATH = os.path.join(BASE_DIR, 'reply.json')
 REPLIED_SENDERS_PATH = os.path.join(BASE_DIR, 'replied_senders.csv')
+REPLIED_DB_PATH = os.path.join(BASE_DIR, 'replied_senders.db')
 CHARACTERS_DIR = os.path.join(BASE_DIR, 'characters')
+CHARACTERS_CACHE_PATH = os.path.join(BASE_DIR, '.characters.pkl')
+REPLY_CACHE_PATH = os.path.join(BASE_DIR, '.reply.pkl')
+LLM_CACHE_PATH = os.path.join(BASE_DIR, 'llm_cache.json')
+STATE_PATH = os.path.join(BASE_DIR, 'state.json')
 LOG_DIR = os.path.join(BASE_DIR, 'logs')
 LOG_FILE = os.path.join(LOG_DIR, 'runtime.log')
 
 # Check interval in seconds
 CHECK_INTERVAL = int(os.getenv("CHECK_INTERVAL", "30"))
+# Gmail accepts up to 100 calls per batch request but recommends no more than 50
+BATCH_SIZE = 50
+# Maximum number of sends in flight at once; this caps concurrency, not the send rate
+# (429 rate-limit responses from Gmail are retried on the next poll)
+SEND_WORKERS = 2
+
+EMAIL_TEMPLATE = (
+    "To: {to}\r\n"
+    "From: secure.test@debagnik.in\r\n"
+    "Subject: {subject}\r\n"
+    "MIME-Version: 1.0\r\n"
+    "Content-Type: text/plain; charset=\"utf-8\"\r\n"
+    "Content-Transfer-Encoding: 8bit\r\n"
+    "\r\n"
+    "{body}"
+)
 
 os.makedirs(LOG_DIR, exist_ok=True)
 load_dotenv()
@@ -40,11 +67,25 @@ OLLAMA_API_BASE = os.getenv("OPENAI_API_BASE", "http://localhost:11434/v1")
 OLLAMA_MODEL = os.getenv("MODEL_NAME", "gemma3:4b")
 OLLAMA_KEY = os.getenv("OPENAI_API_KEY", "ollama")
 REPLY_ONCE = os.getenv("REPLY_ONCE", "True").lower() == "true"
+# Number of generated variants kept per prompt before replies are served from cache (0 disables)
+LLM_CACHE_VARIANTS = int(os.getenv("LLM_CACHE_VARIANTS", "5"))
+
+# Optional Gmail push notifications (Cloud Pub/Sub); polling is used when unset
+PUBSUB_TOPIC = os.getenv("PUBSUB_TOPIC")
+PUBSUB_SUBSCRIPTION = os.getenv("PUBSUB_SUBSCRIPTION")
+PUSH_ENABLED = bool(PUBSUB_TOPIC and PUBSUB_SUBSCRIPTION)
+# Gmail watches expire after 7 days, renew a day early
+WATCH_RENEW_INTERVAL = 6 * 24 * 60 * 60
+# Check history this often even without a notification, in case one was missed
+PUSH_FALLBACK_INTERVAL = CHECK_INTERVAL * 20
 
-client = OpenAI(base_url=OLLAMA_API_BASE, api_key=OLLAMA_KEY)
+aclient = None  # Created on first use, see get_ai_client()
 
 shutdown_requested = False
-script_start_time = int(datetime.now(timezone.utc).timestamp())
+_shutdown_event = threading.Event()
+mail_notified = threading.Event()
+_thread_local = threading.local()
+_gmail_discovery_doc = None
 
 # ======================================================
 # GRACEFUL SHUTDOWN HANDLING
@@ -55,6 +96,8 @@ def graceful_shutdown(signum=None, frame=None):
         print("\nStopping bot gracefully... please wait up to 30s for cleanup.")
         logging.info("Graceful shutdown requested.")
         shutdown_requested = True
+        _shutdown_event.set()
+        mail_notified.set()  # Wake a push-mode wait as well
 
 signal.signal(signal.SIGINT, graceful_shutdown)
 signal.signal(signal.SIGTERM, graceful_shutdown)
@@ -62,6 +105,16 @@ signal.signal(signal.SIGTERM, graceful_shutdown)
 # ======================================================
 # GMAIL AUTH
 # ======================================================
+def build_gmail_service(creds):
+    global _gmail_discovery_doc
+    # Parse the discovery document bundled with googleapiclient once and share it between clients
+    if _gmail_discovery_doc is None:
+        doc = get_static_doc('gmail', 'v1')
+        if doc is None:
+            return build('gmail', 'v1', credentials=creds)
+        _gmail_discovery_doc = json.loads(doc)
+    return build_from_document(_gmail_discovery_doc, credentials=creds)
+
 def gmail_authenticate():
     creds = None
     if os.path.exists(TOKEN_PATH):
@@ -70,158 +123,447 @@ def gmail_authenticate():
         if creds and creds.expired and creds.refresh_token:
             creds.refresh(Request())
         else:
+            from google_auth_oauthlib.flow import InstalledAppFlow
             flow = InstalledAppFlow.from_client_secrets_file(CREDENTIALS_PATH, SCOPES)
             creds = flow.run_local_server(port=0)
         with open(TOKEN_PATH, 'w') as token_file:
             token_file.write(creds.to_json())
-    service = build('gmail', 'v1', credentials=creds)
+    service = build_gmail_service(creds)
     profile = service.users().getProfile(userId='me').execute()
-    return service, profile['emailAddress']
+    return service, creds, profile['emailAddress'], profile['historyId']
+
+def get_thread_service(creds):
+    # googleapiclient's httplib2 transport is not thread-safe, so each worker gets its own
+    if not hasattr(_thread_local, 'service'):
+        _thread_local.service = build_gmail_service(creds)
+    return _thread_local.service
 
 # ======================================================
 # EMAIL UTILITIES
 # ======================================================
-def get_unread_messages(service):
-    query = f"is:unread after:{script_start_time}"
-    results = service.users().messages().list(userId='me', labelIds=['INBOX'], q=query).execute()
-    logging.info(f"Checked for unread emails, found: {results}")
-    return results.get('messages', [])
-
-def get_sender(msg):
-    headers = msg['payload']['headers']
-    for header in headers:
-        if header['name'].lower() == 'from':
-            return parseaddr(header['value'])[1]  # Extract only email
-    return None
-
-def load_replied_senders():
-    if not os.path.exists(REPLIED_SENDERS_PATH):
-        return set()
-    with open(REPLIED_SENDERS_PATH, newline='', encoding='utf-8') as f:
-        next(csv.reader(f), None)  # Skip header
-        return set(row[0] for row in csv.reader(f) if row)
-
-def save_replied_sender(sender, character_name, used_fallback):
-    is_new_file = not os.path.exists(REPLIED_SENDERS_PATH)
-    with open(REPLIED_SENDERS_PATH, 'a', newline='', encoding='utf-8') as f:
-        writer = csv.writer(f)
-        if is_new_file:
-            writer.writerow(["sender_email", "timestamp", "character_used", "fallback_used"])
-        writer.writerow([
-            sender,
-            datetime.now(timezone.utc).isoformat(),
-            character_name,
-            "Yes" if used_fallback else "No"
-        ])
+def write_json_atomic(path, data):
+    # Write to a sibling temp file and swap it in, so a crash never leaves a truncated file behind
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+def load_state():
+    if not os.path.exists(STATE_PATH):
+        return None, []
+    try:
+        with open(STATE_PATH, encoding='utf-8') as f:
+            state = json.load(f)
+        return state.get('historyId'), state.get('retryIds', [])
+    except (OSError, ValueError, AttributeError) as e:
+        logging.warning(f"Ignoring unreadable state file, starting from the current mailbox state: {e}")
+        return None, []
+
+def save_state(history_id, retry_ids):
+    # Messages whose fetch or send failed transiently are kept here, the history cursor has already moved past them
+    write_json_atomic(STATE_PATH, {'historyId': history_id, 'retryIds': retry_ids})
+
+def is_retryable(exception):
+    if isinstance(exception, HttpError):
+        return exception.resp.status == 429 or exception.resp.status >= 500
+    return True  # Network errors and the like
+
+def start_watch(service):
+    body = {'topicName': PUBSUB_TOPIC, 'labelIds': ['INBOX'], 'labelFilterBehavior': 'INCLUDE'}
+    response = service.users().watch(userId='me', body=body).execute()
+    logging.info(f"Gmail watch registered on {PUBSUB_TOPIC}, expires: {response.get('expiration')}")
+    return response['historyId']
+
+def start_pubsub_listener():
+    from google.cloud import pubsub_v1
+
+    def on_message(message):
+        message.ack()
+        mail_notified.set()
+
+    def on_listener_done(future):
+        if shutdown_requested or future.cancelled():
+            return
+        logging.error(f"Pub/Sub listener stopped, falling back to polling every {CHECK_INTERVAL}s: {future.exception()}")
+        mail_notified.set()  # Wake the main loop so it switches to polling right away
+
+    subscriber = pubsub_v1.SubscriberClient()
+    logging.info(f"Listening for Gmail notifications on {PUBSUB_SUBSCRIPTION}")
+    listener = subscriber.subscribe(PUBSUB_SUBSCRIPTION, callback=on_message)
+    listener.add_done_callback(on_listener_done)
+    return listener
+
+def get_new_message_ids(service, start_history_id):
+    message_ids = []
+    history_id = start_history_id
+    page_token = None
+    while True:
+        results = service.users().history().list(
+            userId='me', startHistoryId=start_history_id, historyTypes=['messageAdded'],
+            labelId='INBOX', pageToken=page_token,
+            fields='history/messagesAdded/message/id,historyId,nextPageToken'
+        ).execute()
+        for record in results.get('history', []):
+            for added in record.get('messagesAdded', []):
+                message_ids.append(added['message']['id'])
+        history_id = results.get('historyId', history_id)
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            break
+    logging.info(f"Checked mailbox history since {start_history_id}, found {len(message_ids)} new message(s)")
+    return list(dict.fromkeys(message_ids)), history_id
+
+def get_messages(service, message_ids):
+    results = {}
+    failed_ids = []
+
+    def collect(request_id, response, exception):
+        if exception is not None:
+            logging.error(f"Failed to fetch message {request_id}: {exception}")
+            if is_retryable(exception):
+                failed_ids.append(request_id)
+            return
+        results[request_id] = response
+
+    for start in range(0, len(message_ids), BATCH_SIZE):
+        batch = service.new_batch_http_request(callback=collect)
+        for msg_id in message_ids[start:start + BATCH_SIZE]:
+            batch.add(
+                service.users().messages().get(
+                    userId='me', id=msg_id, format='metadata', metadataHeaders=['From', 'Subject'],
+                    fields='id,labelIds,payload/headers'
+                ),
+                request_id=msg_id
+            )
+        batch.execute()
+    return [results[msg_id] for msg_id in message_ids if msg_id in results], failed_ids
+
+def get_headers(msg):
+    return {header['name'].lower(): header['value'] for header in msg['payload'].get('headers', [])}
+
+def get_sender(headers):
+    if 'from' not in headers:
+        return None
+    return parseaddr(headers['from'])[1] or None  # Extract only email
+
+def open_replied_db():
+    conn = sqlite3.connect(REPLIED_DB_PATH)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS replied ("
+        "sender_email TEXT NOT NULL, timestamp TEXT, character_used TEXT, fallback_used INTEGER)"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS replied_sender ON replied (sender_email)")
+    # One-time import of the legacy CSV log
+    is_empty = conn.execute("SELECT 1 FROM replied LIMIT 1").fetchone() is None
+    if is_empty and os.path.exists(REPLIED_SENDERS_PATH):
+        with open(REPLIED_SENDERS_PATH, newline='', encoding='utf-8') as f:
+            reader = csv.reader(f)
+            next(reader, None)  # Skip header
+            conn.executemany(
+                "INSERT INTO replied VALUES (?, ?, ?, ?)",
+                ((row[0], row[1], row[2], int(row[3] == "Yes")) for row in reader if len(row) >= 4)
+            )
+        logging.info(f"Imported replied senders from {REPLIED_SENDERS_PATH}")
+    conn.commit()
+    return conn
+
+def has_replied(conn, sender):
+    return conn.execute("SELECT 1 FROM replied WHERE sender_email = ? LIMIT 1", (sender,)).fetchone() is not None
+
+def save_replied_sender(conn, sender, character_name, used_fallback, ts=None):
+    if ts is None:
+        ts = datetime.now(timezone.utc).isoformat(timespec='seconds')
+    conn.execute(
+        "INSERT INTO replied VALUES (?, ?, ?, ?)",
+        (sender, ts, character_name, int(used_fallback))
+    )
+
+def file_signature(path):
+    stat = os.stat(path)
+    return os.path.basename(path), stat.st_mtime_ns, stat.st_size
+
+def load_cached(cache_path, key):
+    try:
+        with open(cache_path, 'rb') as f:
+            cached_key, data = pickle.load(f)
+    except Exception:
+        return None  # Best-effort cache: any unreadable or foreign pickle just means re-parsing the JSON
+    return data if cached_key == key else None
+
+def save_cached(cache_path, key, data):
+    try:
+        with open(cache_path, 'wb') as f:
+            pickle.dump((key, data), f, protocol=pickle.HIGHEST_PROTOCOL)
+    except OSError as e:
+        logging.warning(f"Could not write cache {cache_path}: {e}")
 
 def load_characters():
     characters = []
     if os.path.exists(CHARACTERS_DIR):
-        for file in os.listdir(CHARACTERS_DIR):
-            if file.endswith('.json'):
-                with open(os.path.join(CHARACTERS_DIR, file), encoding='utf-8') as f:
-                    characters.append(json.load(f))
+        files = sorted(os.path.join(CHARACTERS_DIR, file) for file in os.listdir(CHARACTERS_DIR) if file.endswith('.json'))
+        key = tuple(file_signature(path) for path in files)
+        cached = load_cached(CHARACTERS_CACHE_PATH, key)
+        if cached is not None:
+            return cached
+        for path in files:
+            with open(path, 'rb') as f:
+                characters.append(orjson.loads(f.read()))
+        save_cached(CHARACTERS_CACHE_PATH, key, characters)
     return characters
 
 def load_fallback_message():
     if not os.path.exists(REPLY_JSON_PATH):
         return "Thank you for reaching out! I'll get back to you soon."
-    with open(REPLY_JSON_PATH, encoding='utf-8') as f:
-        data = json.load(f)
-        return data.get('message', "Thank you for your email!")
+    key = file_signature(REPLY_JSON_PATH)
+    cached = load_cached(REPLY_CACHE_PATH, key)
+    if cached is not None:
+        return cached
+    with open(REPLY_JSON_PATH, 'rb') as f:
+        data = orjson.loads(f.read())
+        message = data.get('message', "Thank you for your email!")
+    save_cached(REPLY_CACHE_PATH, key, message)
+    return message
+
+def prepare_prompt(character):
+    character['_system_prompt'] = (
+        f"You are {character.get('name')}, a {character.get('style')} persona. "
+        f"Facts about you: {character.get('randomFacts', [])}. "
+        f"Personality quirks: {character.get('quirks', [])}. "
+        f"Your task: rewrite and deliver the following message so that it keeps ALL its information, facts, and meaning intact, "
+        f"but sounds exactly like something {character.get('name')} would say — their tone, habits, mannerisms, and emotional nuance. "
+        f"Do not shorten or omit any factual part of the message. "
+        f"Keep it readable as an in-character email reply, not a script or stage direction. "
+        f"The user will send you the message you must fully express in character."
+    )
+
+def load_llm_cache():
+    if not os.path.exists(LLM_CACHE_PATH):
+        return {}
+    try:
+        with open(LLM_CACHE_PATH, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        logging.warning(f"Ignoring unreadable reply cache: {e}")
+        return {}
 
-def generate_ai_reply(prompt):
+def save_llm_cache():
     try:
-        completion = client.chat.completions.create(
+        write_json_atomic(LLM_CACHE_PATH, llm_cache)
+    except OSError as e:
+        logging.warning(f"Could not write reply cache {LLM_CACHE_PATH}: {e}")
+
+llm_cache = load_llm_cache()
+
+def get_ai_client():
+    global aclient
+    if aclient is None:
+        from openai import AsyncOpenAI
+        aclient = AsyncOpenAI(base_url=OLLAMA_API_BASE, api_key=OLLAMA_KEY)
+    return aclient
+
+async def generate_ai_reply(system_prompt, message):
+    key = hashlib.sha256(f"{system_prompt}\0{message}".encode('utf-8')).hexdigest()
+    variants = llm_cache.get(key, [])
+    if LLM_CACHE_VARIANTS and len(variants) >= LLM_CACHE_VARIANTS:
+        return choice(variants), False
+    try:
+        stream = await get_ai_client().chat.completions.create(
             model=OLLAMA_MODEL,
-            messages=[{"role": "user", "content": prompt}]
+            # A fixed per-character system prompt lets the server reuse its prefix KV cache
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": message}
+            ],
+            stream=True
         )
-        return completion.choices[0].message.content.strip()
+        chunks = []
+        async for event in stream:
+            if event.choices:
+                chunks.append(event.choices[0].delta.content or '')
+        reply = ''.join(chunks).strip()
     except Exception as e:
         logging.error(f"Ollama API error: {e}")
-        return None
+        # Prefer an earlier in-character reply over the plain message, but still report it as a fallback
+        return (choice(variants) if variants else None), True
+    variants = llm_cache.setdefault(key, [])
+    if LLM_CACHE_VARIANTS and reply and len(variants) < LLM_CACHE_VARIANTS:
+        variants.append(reply)
+        save_llm_cache()
+    return reply, False
+
+def encode_header_value(value):
+    value = ' '.join(value.split())  # Folds any CR/LF so the header cannot be split
+    if value.isascii():
+        return value
+    from email.header import Header
+    return Header(value, 'utf-8').encode(linesep='\r\n')  # Fold with CRLF like the rest of the message
 
 def send_reply(service, to_email, subject, message_body, character):
     message_body = f"{message_body}\n\n-{character.get('name', 'Automated System')}."
-    reply = MIMEText(message_body)
-    reply['to'] = to_email
-    reply['subject'] = f"Re: {subject} - OOO Automated Reply"
-    reply['From'] = f"secure.test@debagnik.in"
-    raw = base64.urlsafe_b64encode(reply.as_bytes()).decode()
+    reply = EMAIL_TEMPLATE.format(
+        to=''.join(to_email.split()),  # Bare address from parseaddr; encoded-words are not valid here
+        subject=encode_header_value(f"Re: {subject} - OOO Automated Reply"),
+        body='\r\n'.join(message_body.splitlines())
+    )
+    raw = base64.urlsafe_b64encode(reply.encode('utf-8')).decode('ascii')
     service.users().messages().send(userId='me', body={'raw': raw}).execute()
 
+def send_reply_threaded(creds, to_email, subject, message_body, character):
+    send_reply(get_thread_service(creds), to_email, subject, message_body, character)
+
 # ======================================================
 # MAIN LOOP
 # ======================================================
-def main():
+async def main():
     """
     Start and run the Gmail Auto Reply Bot: authenticate, poll for unread messages, generate persona-based replies, send emails, and record replied senders.
     
-    This function authenticates to Gmail, loads character profiles and a fallback reply, then enters a loop that polls for unread messages until a shutdown is requested. For each new message it selects a character persona, constructs an AI prompt, attempts to generate a persona-styled reply (falling back to the configured fallback message on failure), sends the reply via Gmail, and persists a record of the sender with the character used and whether the fallback was used. It performs responsive sleeping between polls, handles graceful shutdown, logs runtime events, and continues operation after non-critical errors.
+    This coroutine authenticates to Gmail, loads character profiles and a fallback reply, then enters a loop that polls Gmail's mailbox history for newly added inbox messages until a shutdown is requested. The last processed history ID is persisted so a restart resumes where the previous run stopped. When Pub/Sub push is configured it instead registers a Gmail watch and only fetches history deltas after a notification arrives, renewing the watch before it expires and falling back to regular polling if the listener or watch cannot be set up. For each new message it selects a character persona, constructs an AI prompt, and attempts to generate a persona-styled reply (falling back to the configured fallback message on failure); replies for all messages in a poll are generated concurrently. Replies are then sent concurrently from a small thread pool, each worker using its own Gmail client, and a record of the sender is persisted with the character used and whether the fallback was used. Blocking Gmail calls run in worker threads so they do not stall the event loop. It performs responsive sleeping between polls, handles graceful shutdown, logs runtime events, and continues operation after non-critical errors.
     """
     logging.info("Starting Gmail Auto Reply Bot (Windows)")
     print(f"Gmail Auto Reply Bot started. Press Ctrl+C to stop. (Reply once per sender: {REPLY_ONCE})")
-    service, my_email = gmail_authenticate()
+    service, creds, my_email, current_history_id = gmail_authenticate()
+    send_executor = ThreadPoolExecutor(max_workers=SEND_WORKERS, thread_name_prefix='send')
+    loop = asyncio.get_running_loop()
+    # Resume from the last processed mailbox state so mail received while stopped is not missed
+    history_id, retry_ids = load_state()
+    history_id = history_id or current_history_id
 
-    replied_senders = load_replied_senders()
+    replied_db = open_replied_db()
     characters = load_characters()
     fallback_message = load_fallback_message()
 
     if not characters:
         logging.warning("No character profiles found. Using default reply personality.")
         characters = [{"name": "Default", "style": "friendly"}]
+    for character in characters:
+        prepare_prompt(character)
+
+    def select_messages(msgs):
+        selected = []
+        seen = set()
+        for msg in msgs:
+            if 'UNREAD' not in msg.get('labelIds', []):
+                continue  # Already read by the user
+            headers = get_headers(msg)
+            sender = get_sender(headers)
+            if not sender or sender == my_email or (REPLY_ONCE and (sender in seen or has_replied(replied_db, sender))):
+                continue  # Skip if self or already replied (when toggle on), including earlier in this poll
+            seen.add(sender)
+            selected.append((msg['id'], sender, headers))
+        return selected
+
+    async def handle(msg_id, sender, headers):
+        character = choice(characters)
+
+        # Use reply.json content as prompt only
+        ai_reply, used_fallback = await generate_ai_reply(character['_system_prompt'], fallback_message)
+        if not ai_reply:
+            ai_reply = fallback_message
+            used_fallback = True
+        subject = headers.get('subject') or "Automated Reply"
+        return msg_id, sender, subject, character, ai_reply, used_fallback
+
+    listener = None
+    watch_started = None  # The watch is registered, and later renewed, at the top of the loop
+    if PUSH_ENABLED:
+        try:
+            listener = await asyncio.to_thread(start_pubsub_listener)
+        except Exception as e:
+            logging.error(f"Could not start the Pub/Sub listener, polling every {CHECK_INTERVAL}s instead: {e}")
 
     while not shutdown_requested:
         try:
-            messages = get_unread_messages(service)
-            for msg_meta in messages:
-                msg = service.users().messages().get(userId='me', id=msg_meta['id']).execute()
-                sender = get_sender(msg)
-                if not sender or (REPLY_ONCE and sender in replied_senders) or sender == my_email:
-                    continue  # Skip if already replied (when toggle on) or self
-
-                character = choice(characters)
-
-                # Use reply.json content as prompt only
-                prompt = (
-                            f"You are {character.get('name')}, a {character.get('style')} persona. "
-                            f"Facts about you: {character.get('randomFacts', [])}. "
-                            f"Personality quirks: {character.get('quirks', [])}. "
-                            f"Your task: rewrite and deliver the following message so that it keeps ALL its information, facts, and meaning intact, "
-                            f"but sounds exactly like something {character.get('name')} would say — their tone, habits, mannerisms, and emotional nuance. "
-                            f"Do not shorten or omit any factual part of the message. "
-                            f"Keep it readable as an in-character email reply, not a script or stage direction. "
-                            f"Here is the message you must fully express in character:\n\"{fallback_message}\""
-                )
-                ai_reply = generate_ai_reply(prompt)
-                used_fallback = False
-                if not ai_reply:
-                    ai_reply = fallback_message
-                    used_fallback = True
-
-                send_reply(service, sender, "Automated Reply", ai_reply, character)
-
-                
-                replied_senders.add(sender)
-                save_replied_sender(sender, character.get('name'), used_fallback)
+            if listener is not None:
+                if watch_started is None or time.monotonic() - watch_started >= WATCH_RENEW_INTERVAL:
+                    try:
+                        await asyncio.to_thread(start_watch, service)
+                        watch_started = time.monotonic()
+                    except Exception as e:
+                        # Mail is still picked up by the periodic history check; registration is retried next poll
+                        logging.error(f"Gmail watch registration failed: {e}")
+                mail_notified.clear()
+            try:
+                message_ids, new_history_id = await asyncio.to_thread(get_new_message_ids, service, history_id)
+            except HttpError as e:
+                if e.resp.status != 404:
+                    raise
+                # History IDs expire after about a week; restart from the current mailbox state
+                logging.warning(f"History ID {history_id} is no longer valid, resetting")
+                profile = await asyncio.to_thread(service.users().getProfile(userId='me').execute)
+                history_id = profile['historyId']
+                save_state(history_id, retry_ids)
+                continue
+            # Messages whose fetch or send failed on an earlier poll are retried along with the new ones
+            message_ids = list(dict.fromkeys(retry_ids + message_ids))
+            msgs, retry_ids = await asyncio.to_thread(get_messages, service, message_ids)
+            selected = select_messages(msgs)
+            replies = await asyncio.gather(*[handle(*item) for item in selected], return_exceptions=True)
+
+            pending = []
+            for (msg_id, sender, headers), reply in zip(selected, replies):
+                if isinstance(reply, Exception):
+                    # generate_ai_reply() handles Ollama errors itself, anything raised here is a bug and would recur
+                    logging.error(f"Failed to prepare reply to {sender}, skipping message {msg_id}: {reply}")
+                    continue
+                pending.append(reply)
+
+            sends = [
+                loop.run_in_executor(send_executor, send_reply_threaded, creds, sender, subject, ai_reply, character)
+                for msg_id, sender, subject, character, ai_reply, used_fallback in pending
+            ]
+            results = await asyncio.gather(*sends, return_exceptions=True)
+            ts = datetime.now(timezone.utc).isoformat(timespec='seconds')  # Shared by the whole batch
+
+            for (msg_id, sender, subject, character, ai_reply, used_fallback), result in zip(pending, results):
+                if isinstance(result, Exception):
+                    logging.error(f"Failed to send reply to {sender}: {result}")
+                    if is_retryable(result):
+                        retry_ids.append(msg_id)  # Answered on the next poll
+                    continue
+
+                save_replied_sender(replied_db, sender, character.get('name'), used_fallback, ts=ts)
 
                 logging.info(f"Replied to {sender} with persona {character.get('name')}, fallback: {used_fallback}")
                 print(f"✔ Replied to {sender} ({character.get('name')}){' [fallback]' if used_fallback else ''}")
 
-            # Responsive sleep using CHECK_INTERVAL
-            for _ in range(CHECK_INTERVAL):
-                if shutdown_requested:
-                    break
-                time.sleep(1)
+            if pending:
+                replied_db.commit()  # One commit per poll rather than per reply
+
+            if new_history_id != history_id or message_ids:
+                history_id = new_history_id
+                save_state(history_id, retry_ids)
+
+            if listener is not None:
+                # Idle until Gmail pushes a notification or the watch is due for renewal,
+                # checking history periodically anyway and polling normally if push is not working
+                if listener.done() or watch_started is None:
+                    timeout = CHECK_INTERVAL
+                else:
+                    renew_in = max(0, WATCH_RENEW_INTERVAL - (time.monotonic() - watch_started))
+                    timeout = min(renew_in, PUSH_FALLBACK_INTERVAL)
+                await asyncio.to_thread(mail_notified.wait, timeout)
+                continue
+
+            # Sleep for CHECK_INTERVAL, waking immediately on shutdown
+            if await asyncio.to_thread(_shutdown_event.wait, CHECK_INTERVAL):
+                break
 
         except KeyboardInterrupt:
             graceful_shutdown()
         except Exception as e:
             logging.error(f"Runtime error: {e}")
-            time.sleep(5)
+            await asyncio.sleep(5)
+
+    if listener is not None:
+        listener.cancel()
+
+    send_executor.shutdown(wait=True)
+    replied_db.commit()
+    replied_db.close()
 
     logging.info("Bot stopped gracefully.")
     print("Bot stopped gracefully.")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    asyncio.run(main())
\ No newline at end of file